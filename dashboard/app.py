@@ -5,13 +5,22 @@ Streamlit Dashboard для анализа выбросов в атмосферу
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
+import os
 import sqlite3
 from datetime import datetime
 import warnings
 warnings.filterwarnings('ignore')
 
+# DuckDB выполняет джойны и агрегаты колоночно и многопоточно;
+# без него работаем по резервному пути pandas + sqlite
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
 # Настройки страницы
 st.set_page_config(
     page_title="Air Quality Analytics",
@@ -23,174 +32,384 @@ st.set_page_config(
 # Глобальная переменная для пути к БД
 db_path = "data/air_emissions.db"
 csv_path = "data/air_emissions.csv"
+parquet_cache_path = "data/air_emissions_cache.parquet"
 
-# Функция для создания нового соединения в каждом потоке
+# Одно соединение на процесс: st.cache_resource переживает rerun'ы,
+# так что PRAGMA-настройка выполняется один раз, а не на каждый запрос
+@st.cache_resource
 def get_connection():
-    """Создает новое соединение с БД в текущем потоке"""
-    return sqlite3.connect(db_path, check_same_thread=False)
+    """Возвращает общее соединение с БД (кэшируется Streamlit)"""
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+    # Настройки под интенсивное чтение: WAL не блокирует читателей,
+    # пока ETL пишет, mmap и большой кэш страниц ускоряют джойны
+    for pragma in (
+        "PRAGMA journal_mode=WAL;",
+        "PRAGMA synchronous=NORMAL;",
+        "PRAGMA temp_store=MEMORY;",
+        "PRAGMA cache_size=-65536;",
+        "PRAGMA mmap_size=268435456;",
+    ):
+        conn.execute(pragma)
+    return conn
 
-# Функция загрузки данных с правильными джойнами
-@st.cache_data(ttl=3600)
-def load_data():
-    """Загружает данные из базы"""
+# Индексы и представление под запросы дашборда (создаются один раз на процесс)
+@st.cache_resource
+def init_indexes():
+    """Создает индексы, представление и статистику планировщика"""
     conn = get_connection()
-    
-    try:
-        # Получаем все вещества с их типами
-        query_substances = """
-        SELECT DISTINCT substance, source_type 
-        FROM substance_types 
-        WHERE source_type IS NOT NULL AND source_type != ''
-        """
-        substances_df = pd.read_sql_query(query_substances, conn)
-        
-        # Создаем словарь: вещество -> список его типов
-        substance_types_dict = {}
-        for _, row in substances_df.iterrows():
-            if row['substance'] not in substance_types_dict:
-                substance_types_dict[row['substance']] = []
-            substance_types_dict[row['substance']].append(row['source_type'])
-        
-        # Основной запрос данных
-        query = """
-        SELECT 
-            ae.section,
-            ae.code,
-            ae.substance,
+    for ddl in (
+        "CREATE INDEX IF NOT EXISTS idx_ae_section_year ON air_emissions(section_id, year);",
+        "CREATE INDEX IF NOT EXISTS idx_ae_oktmo ON air_emissions(oktmo_id);",
+        "CREATE INDEX IF NOT EXISTS idx_ae_code ON air_emissions(code_id);",
+        # Индексы по правым сторонам джойнов load_filtered_data
+        "CREATE INDEX IF NOT EXISTS idx_ic_code ON indicator_codes(code_id);",
+        "CREATE INDEX IF NOT EXISTS idx_lc_oktmo ON location_codes(oktmo_id);",
+        # Частичный индекс ровно под предикат дашборда value > 0
+        "CREATE INDEX IF NOT EXISTS idx_ae_value ON air_emissions(value) WHERE value > 0;",
+        # Готовое представление джойнов дашборда: факт-таблица хранит
+        # целочисленные ключи, человекочитаемые строки подтягиваются
+        # из справочников
+        """CREATE VIEW IF NOT EXISTS v_air_emissions AS
+        SELECT
+            s.section,
+            ic.code,
+            st.substance,
             ae.value,
-            ae.oktmo_code,
+            lc.oktmo_code,
             ae.year,
             ic.indicator,
             lc.region,
             lc.municipal_district,
             lc.municipal_formation
         FROM air_emissions ae
-        LEFT JOIN indicator_codes ic ON ae.code = ic.code
-        LEFT JOIN location_codes lc ON ae.oktmo_code = lc.oktmo_code
-        WHERE ae.value > 0  -- Только положительные значения
-        """
-        
-        df = pd.read_sql_query(query, conn)
-        
-        # Преобразуем типы данных
-        if 'year' in df.columns:
-            df['year'] = pd.to_numeric(df['year'], errors='coerce')
-        if 'value' in df.columns:
-            df['value'] = pd.to_numeric(df['value'], errors='coerce')
-        
-        # Добавляем информацию о типах веществ
-        def get_substance_info(substance):
-            if substance in substance_types_dict:
-                types = substance_types_dict[substance]
-                if len(types) == 1:
-                    return types[0], types[0]  # название и отображение
-                else:
-                    # Если несколько типов, объединяем их
-                    display_name = f"{substance} ({', '.join(types)})"
-                    return types[0], display_name
-            else:
-                return substance, substance
-        
-        # Применяем функцию к каждому веществу
-        substance_info = df['substance'].apply(get_substance_info)
-        df['substance_name'] = substance_info.apply(lambda x: x[0])
-        df['substance_display'] = substance_info.apply(lambda x: x[1])
-        
+        LEFT JOIN sections s ON ae.section_id = s.section_id
+        LEFT JOIN indicator_codes ic ON ae.code_id = ic.code_id
+        LEFT JOIN substance_types st ON ae.substance_id = st.substance_id
+        LEFT JOIN location_codes lc ON ae.oktmo_id = lc.oktmo_id
+        WHERE ae.value > 0;""",
+        # Статистика sqlite_stat1 помогает планировщику выбрать порядок джойна
+        "ANALYZE;",
+    ):
+        conn.execute(ddl)
+    conn.commit()
+
+# Функция загрузки доменов фильтров (небольшие DISTINCT-списки для виджетов)
+@st.cache_data(ttl=3600)
+def load_filter_domains():
+    """Загружает уникальные значения для виджетов боковой панели"""
+    conn = get_connection()
+    # Возвращаем кортежи: неизменяемые значения Streamlit хэширует дешево.
+    # Домены строк берутся из маленьких справочников — ETL гарантирует,
+    # что они покрывают ровно значения, встречающиеся в факт-таблице
+    sections = tuple(pd.read_sql_query(
+        "SELECT DISTINCT section FROM sections "
+        "WHERE section IS NOT NULL ORDER BY section", conn
+    )['section'].astype(str))
+    years = tuple(pd.read_sql_query(
+        "SELECT DISTINCT year FROM air_emissions "
+        "WHERE year IS NOT NULL ORDER BY year", conn
+    )['year'].astype(int))
+    regions = tuple(pd.read_sql_query(
+        "SELECT DISTINCT region FROM location_codes "
+        "WHERE region IS NOT NULL ORDER BY region", conn
+    )['region'])
+    substances = tuple(pd.read_sql_query(
+        "SELECT DISTINCT substance FROM substance_types "
+        "WHERE substance IS NOT NULL ORDER BY substance", conn
+    )['substance'])
+    codes = tuple(pd.read_sql_query(
+        "SELECT DISTINCT code FROM indicator_codes "
+        "WHERE code IS NOT NULL AND code != '' ORDER BY code", conn
+    )['code'])
+    return sections, years, regions, substances, codes
+
+def _parquet_cache_fresh():
+    """Parquet-снимок актуален, если он не старше файла базы"""
+    try:
+        return os.path.getmtime(parquet_cache_path) >= os.path.getmtime(db_path)
+    except OSError:
+        return False
+
+# Parquet-снимок объединенной выборки: холодный старт процесса читает
+# колоночный файл вместо повторного SQL-джойна по всей базе
+@st.cache_resource
+def ensure_parquet_cache():
+    """Обновляет parquet-снимок при устаревании; возвращает путь или None"""
+    if _parquet_cache_fresh():
+        return parquet_cache_path
+    try:
+        df = _query_filtered_data()
+        df.to_parquet(parquet_cache_path, compression='zstd')
+        return parquet_cache_path
+    except Exception:
+        # Нет прав на запись, нет места и т.п. — работаем напрямую из SQL
+        return None
+
+@st.cache_resource
+def get_duckdb():
+    """Возвращает общее in-process соединение DuckDB"""
+    return duckdb.connect() if duckdb is not None else None
+
+def _duckdb_where(section=None, years=(), regions=(), substances=(), codes=()):
+    """Собирает параметризованный WHERE по выбранным фильтрам"""
+    clauses, params = [], []
+    if section:
+        clauses.append("section = ?")
+        params.append(section)
+    if years:
+        clauses.append(f"year IN ({','.join('?' * len(years))})")
+        params.extend(int(y) for y in years)
+    if regions:
+        clauses.append(f"region IN ({','.join('?' * len(regions))})")
+        params.extend(regions)
+    if substances:
+        clauses.append(f"substance IN ({','.join('?' * len(substances))})")
+        params.extend(substances)
+    if codes:
+        clauses.append(f"code IN ({','.join('?' * len(codes))})")
+        params.extend(codes)
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+    return where, params
+
+# Функция загрузки данных с правильными джойнами и фильтрами на стороне SQL
+@st.cache_data(ttl=3600)
+def load_filtered_data(section=None, years=(), regions=(), substances=(), codes=()):
+    """Загружает отфильтрованные данные из parquet-снимка или из базы"""
+    path = ensure_parquet_cache()
+    if path is not None and duckdb is not None:
+        # DuckDB читает parquet векторно и сам проталкивает предикаты
+        where, params = _duckdb_where(section, years, regions, substances, codes)
+        df = get_duckdb().execute(
+            f"SELECT * FROM read_parquet(?){where}", [path] + params
+        ).df()
+        for c in ('section', 'substance', 'substance_name', 'substance_display',
+                  'region', 'municipal_district', 'municipal_formation',
+                  'indicator', 'code'):
+            df[c] = df[c].astype('category')
         return df
-        
-    finally:
-        conn.close()
+    if path is not None:
+        # Фильтры уходят в pyarrow и применяются на уровне row group'ов
+        filters = []
+        if section:
+            filters.append(('section', '==', section))
+        if years:
+            filters.append(('year', 'in', [int(y) for y in years]))
+        if regions:
+            filters.append(('region', 'in', list(regions)))
+        if substances:
+            filters.append(('substance', 'in', list(substances)))
+        if codes:
+            filters.append(('code', 'in', list(codes)))
+        return pd.read_parquet(path, filters=filters or None)
+    return _query_filtered_data(section, years, regions, substances, codes)
+
+def _query_filtered_data(section=None, years=(), regions=(), substances=(), codes=()):
+    """Загружает данные из базы; фильтры выполняются в SQL, а не в pandas"""
+    conn = get_connection()
+
+    # Получаем все вещества с их типами
+    query_substances = """
+    SELECT DISTINCT substance, source_type
+    FROM substance_types
+    WHERE source_type IS NOT NULL AND source_type != ''
+    """
+    substances_df = pd.read_sql_query(query_substances, conn)
+
+    # Небольшой справочник: вещество -> название и отображаемое имя
+    lookup = substances_df.groupby('substance', sort=False)['source_type'].agg(list).reset_index()
+    lookup['substance_name'] = lookup['source_type'].str[0]
+    # Если у вещества несколько типов, объединяем их в отображаемом имени
+    lookup['substance_display'] = np.where(
+        lookup['source_type'].str.len().eq(1),
+        lookup['substance_name'],
+        lookup['substance'] + ' (' + lookup['source_type'].str.join(', ') + ')'
+    )
+
+    # Основной запрос данных: джойн уже зашит в представление, фильтр
+    # value > 0 тоже; планировщик проталкивает предикаты внутрь
+    query = "SELECT * FROM v_air_emissions WHERE 1=1"
+
+    # Достраиваем WHERE по выбранным фильтрам (параметризованный запрос)
+    params = []
+    if section:
+        query += " AND section = ?"
+        params.append(section)
+    if years:
+        query += f" AND year IN ({','.join('?' * len(years))})"
+        params.extend(years)
+    if regions:
+        query += f" AND region IN ({','.join('?' * len(regions))})"
+        params.extend(regions)
+    if substances:
+        query += f" AND substance IN ({','.join('?' * len(substances))})"
+        params.extend(substances)
+    if codes:
+        query += f" AND code IN ({','.join('?' * len(codes))})"
+        params.extend(codes)
+
+    df = pd.read_sql_query(query, conn, params=params)
+    
+    # Преобразуем типы данных; узкие числовые типы вдвое сокращают
+    # объем данных, прокачиваемый через каждый groupby/sum
+    if 'year' in df.columns:
+        df['year'] = pd.to_numeric(df['year'], errors='coerce').astype('Int16')
+    if 'value' in df.columns:
+        df['value'] = pd.to_numeric(
+            pd.to_numeric(df['value'], errors='coerce'), downcast='float'
+        )
+    
+    # Добавляем информацию о типах веществ через merge со справочником
+    df = df.merge(
+        lookup[['substance', 'substance_name', 'substance_display']],
+        on='substance', how='left'
+    )
+    df['substance_name'] = df['substance_name'].fillna(df['substance'])
+    df['substance_display'] = df['substance_display'].fillna(df['substance'])
+
+    # Низкокардинальные строковые столбцы храним как category:
+    # groupby/isin/unique работают по целочисленным кодам, а не по строкам,
+    # и кэшируемый DataFrame занимает в разы меньше памяти
+    categorical_cols = (
+        'section', 'substance', 'substance_name', 'substance_display',
+        'region', 'municipal_district', 'municipal_formation',
+        'indicator', 'code'
+    )
+    for c in categorical_cols:
+        df[c] = df[c].astype('category')
+
+    return df
+
+
+# Общая агрегация по всем ключам, которые используют вкладки; считается
+# один раз на сигнатуру фильтров, вкладки доагрегируют уже маленький результат
+@st.cache_data(ttl=3600)
+def load_aggregated(section=None, years=(), regions=(), substances=(), codes=()):
+    """Возвращает суммы выбросов по полному набору ключей вкладок"""
+    path = ensure_parquet_cache()
+    if path is not None and duckdb is not None:
+        # Агрегат целиком в DuckDB — pandas получает уже маленький результат
+        where, params = _duckdb_where(section, years, regions, substances, codes)
+        return get_duckdb().execute(
+            "SELECT year, region, municipal_district, code, indicator,"
+            " substance, substance_display, SUM(value) AS value"
+            f" FROM read_parquet(?){where}"
+            " GROUP BY 1, 2, 3, 4, 5, 6, 7",
+            [path] + params
+        ).df()
+    df = load_filtered_data(
+        section=section, years=years, regions=regions,
+        substances=substances, codes=codes
+    )
+    # dropna=False: строки с NULL-локацией (нет кода ОКТМО в справочнике)
+    # остаются в агрегате, как в пути DuckDB, где NULL — обычная группа
+    agg = df.groupby(
+        ['year', 'region', 'municipal_district', 'code', 'indicator',
+         'substance', 'substance_display'],
+        observed=True, sort=False, dropna=False
+    )['value'].sum().reset_index()
+    return agg
 
 # Функция для получения всех веществ с типами
 @st.cache_data(ttl=3600)
 def get_all_substances_with_types():
     """Загружает все вещества с их типами из БД"""
     conn = get_connection()
-    try:
-        query = """
-        SELECT DISTINCT 
-            st.substance,
-            st.source_type as substance_type,
-            COUNT(*) as count
-        FROM substance_types st
-        WHERE st.source_type IS NOT NULL AND st.source_type != ''
-        GROUP BY st.substance, st.source_type
-        ORDER BY st.substance, count DESC
-        """
-        df = pd.read_sql_query(query, conn)
-        
-        # Группируем по веществам
-        substances_dict = {}
-        for substance, group in df.groupby('substance'):
-            types = group['substance_type'].tolist()
-            if len(types) == 1:
-                substances_dict[substance] = types[0]
-            else:
-                # Для веществ с несколькими типами создаем составное название
-                substances_dict[substance] = f"{substance} ({', '.join(types[:2])}{'...' if len(types) > 2 else ''})"
-        
-        # Добавляем вещества из основной таблицы, которых нет в substance_types
-        query_all_substances = "SELECT DISTINCT substance FROM air_emissions WHERE substance IS NOT NULL"
-        all_substances_df = pd.read_sql_query(query_all_substances, conn)
-        
-        for substance in all_substances_df['substance']:
-            if substance not in substances_dict:
-                substances_dict[substance] = substance
-        
-        return substances_dict
-    finally:
-        conn.close()
+    # Справочник substance_types покрывает все вещества факт-таблицы,
+    # так что достаточно одного скана маленькой таблицы
+    query = """
+    SELECT DISTINCT
+        substance,
+        source_type AS substance_type
+    FROM substance_types
+    WHERE substance IS NOT NULL
+    ORDER BY substance
+    """
+    df = pd.read_sql_query(query, conn)
+
+    # Типы каждого вещества одним groupby.agg, без обхода групп вручную
+    # (NULL и пустые типы не участвуют в отображаемом имени)
+    grp = df.groupby('substance', sort=False)['substance_type'].agg(
+        lambda s: [t for t in s.dropna() if t != '']
+    )
+
+    def _display_name(substance, types):
+        if not types:
+            return substance
+        if len(types) == 1:
+            return types[0]
+        # Для веществ с несколькими типами создаем составное название
+        return f"{substance} ({', '.join(types[:2])}{'...' if len(types) > 2 else ''})"
+
+    return {sub: _display_name(sub, types) for sub, types in grp.items()}
 
 # Функция для получения всех кодов с расшифровками
 @st.cache_data(ttl=3600)
 def get_all_codes_with_descriptions():
     """Загружает все коды с их расшифровками из БД"""
     conn = get_connection()
-    try:
-        query = """
-        SELECT DISTINCT 
-            code,
-            indicator,
-            COUNT(*) as count
-        FROM indicator_codes 
-        WHERE code IS NOT NULL AND code != ''
-        GROUP BY code, indicator
-        ORDER BY code
-        """
-        df = pd.read_sql_query(query, conn)
-        
-        # Создаем словарь: код -> список расшифровок (на случай дубликатов)
-        codes_dict = {}
-        for _, row in df.iterrows():
-            code = row['code']
-            indicator = row['indicator']
-            
-            if code not in codes_dict:
-                codes_dict[code] = []
-            codes_dict[code].append(indicator)
-        
-        # Для кодов с несколькими расшифровками объединяем их
-        codes_display_dict = {}
-        for code, indicators in codes_dict.items():
-            if len(indicators) == 1:
-                codes_display_dict[code] = f"{code} - {indicators[0]}"
-            else:
-                # Объединяем расшифровки через точку с запятой
-                combined = f"{code} - {'; '.join(indicators[:2])}{'...' if len(indicators) > 2 else ''}"
-                codes_display_dict[code] = combined
-        
-        return codes_dict, codes_display_dict
-    finally:
-        conn.close()
+    query = """
+    SELECT DISTINCT 
+        code,
+        indicator,
+        COUNT(*) as count
+    FROM indicator_codes 
+    WHERE code IS NOT NULL AND code != ''
+    GROUP BY code, indicator
+    ORDER BY code
+    """
+    df = pd.read_sql_query(query, conn)
+    
+    # Словарь: код -> список расшифровок (на случай дубликатов)
+    grp = df.groupby('code', sort=False)['indicator'].agg(list)
+    codes_dict = grp.to_dict()
+
+    # Отображаемые имена (первые две расшифровки) строим векторно
+    disp = grp.reset_index()
+    disp['display'] = np.where(
+        disp['indicator'].str.len().eq(1),
+        disp['code'] + ' - ' + disp['indicator'].str[0],
+        disp['code'] + ' - ' + disp['indicator'].str[:2].str.join('; ')
+        + np.where(disp['indicator'].str.len() > 2, '...', '')
+    )
+    codes_display_dict = dict(zip(disp['code'], disp['display']))
+
+    return codes_dict, codes_display_dict
+
+# Варианты для multiselect'ов: сортировка и обратный словарь считаются
+# один раз на набор значений, а не на каждый rerun
+@st.cache_data(ttl=3600)
+def build_substance_options(available, display_items):
+    """Сортированные отображаемые имена веществ и словарь имя -> код"""
+    display_map = dict(display_items)
+    options = sorted(
+        ((sub, display_map.get(sub, sub)) for sub in available),
+        key=lambda x: x[1]
+    )
+    names = [name for _, name in options]
+    return names, {name: code for code, name in options}
+
+@st.cache_data(ttl=3600)
+def build_code_options(available, display_items):
+    """Сортированные отображаемые имена кодов и словарь имя -> код"""
+    display_map = dict(display_items)
+    options = sorted(
+        ((code, display_map.get(code, f"{code} - (без расшифровки)"))
+         for code in available),
+        key=lambda x: x[1]
+    )
+    names = [name for _, name in options]
+    return names, {name: code for code, name in options}
 
 # Основной заголовок
 st.title("Анализ выбросов загрязняющих веществ в атмосферный воздух")
 st.markdown("---")
 
-# Загрузка данных и словарей
+# Загрузка доменов фильтров и словарей
 try:
     with st.spinner("Загрузка данных из базы..."):
-        df = load_data()
+        init_indexes()
+        (available_sections, available_years, available_regions,
+         available_substances, available_codes_in_data) = load_filter_domains()
         all_substances = get_all_substances_with_types()
         all_codes, all_codes_display = get_all_codes_with_descriptions()
         
@@ -215,10 +434,7 @@ with st.sidebar:
     
     # 1. Фильтр по разделам
     st.subheader("Раздел данных")
-    
-    # Получаем уникальные разделы
-    available_sections = sorted(df['section'].dropna().unique().astype(str))
-    
+
     if len(available_sections) == 0:
         st.warning("Нет доступных разделов в данных")
         section = None
@@ -239,9 +455,7 @@ with st.sidebar:
     
     # 2. Фильтр по годам
     st.subheader("Год")
-    
-    available_years = sorted(df['year'].dropna().unique().astype(int))
-    
+
     if len(available_years) == 0:
         st.warning("Нет данных по годам")
         years = []
@@ -263,9 +477,7 @@ with st.sidebar:
     
     # 4. Фильтр по регионам
     st.subheader("Фильтр по регионам")
-    
-    available_regions = sorted(df['region'].dropna().unique())
-    
+
     if len(available_regions) == 0:
         st.warning("Нет данных по регионам")
         selected_regions = []
@@ -278,67 +490,48 @@ with st.sidebar:
     
     # 5. Фильтр по веществам
     st.subheader("Фильтр по веществам")
-    
-    # Получаем ВСЕ уникальные вещества из загруженных данных
-    available_substances = sorted(df['substance'].dropna().unique())
-    
+
     if len(available_substances) == 0:
         st.warning("Нет данных по веществам")
         selected_substances = []
     else:
-        # Создаем список веществ с отображаемыми названиями
-        substance_options = []
-        for sub in available_substances:
-            display_name = all_substances.get(sub, sub)
-            substance_options.append((sub, display_name))
-        
-        # Сортируем по отображаемому названию
-        substance_options.sort(key=lambda x: x[1])
-        
+        # Отображаемые имена и обратный словарь кэшируются по набору значений
+        substance_names, substance_display_to_code = build_substance_options(
+            available_substances, tuple(all_substances.items())
+        )
+
         # Показываем в selectbox с отображаемыми названиями
         selected_display_names = st.multiselect(
             "Выберите вещества",
-            options=[name for _, name in substance_options],
-            default=[name for _, name in substance_options[:3]] if len(substance_options) >= 3 else [name for _, name in substance_options]
+            options=substance_names,
+            default=substance_names[:3] if len(substance_names) >= 3 else substance_names
         )
-        
+
         # Сопоставляем выбранные названия с кодами веществ
-        display_to_code = {name: code for code, name in substance_options}
-        selected_substances = [display_to_code[name] for name in selected_display_names if name in display_to_code]
+        selected_substances = [substance_display_to_code[name] for name in selected_display_names if name in substance_display_to_code]
     
     # 6. НОВЫЙ ФИЛЬТР: Фильтр по кодам (code)
     st.subheader("Фильтр по кодам показателей")
     
     if all_codes_display:
-        # Получаем доступные коды из загруженных данных (с учетом фильтров выше)
-        available_codes_in_data = sorted(df['code'].dropna().unique())
-        
         if len(available_codes_in_data) == 0:
             st.warning("Нет доступных кодов в данных")
             selected_codes = []
         else:
-            # Создаем список кодов с отображаемыми названиями
-            code_options = []
-            for code in available_codes_in_data:
-                if code in all_codes_display:
-                    display_name = all_codes_display[code]
-                else:
-                    display_name = f"{code} - (без расшифровки)"
-                code_options.append((code, display_name))
-            
-            # Сортируем по отображаемому названию
-            code_options.sort(key=lambda x: x[1])
-            
+            # Отображаемые имена и обратный словарь кэшируются по набору значений
+            code_names, code_display_to_code = build_code_options(
+                available_codes_in_data, tuple(all_codes_display.items())
+            )
+
             # Показываем в multiselect
             selected_code_displays = st.multiselect(
                 "Выберите коды показателей",
-                options=[name for _, name in code_options],
+                options=code_names,
                 default=None
             )
-            
+
             # Сопоставляем выбранные названия с кодами
-            display_to_code = {name: code for code, name in code_options}
-            selected_codes = [display_to_code[name] for name in selected_code_displays if name in display_to_code]
+            selected_codes = [code_display_to_code[name] for name in selected_code_displays if name in code_display_to_code]
             
     else:
         st.warning("Нет данных о кодах в базе")
@@ -352,48 +545,45 @@ with st.sidebar:
         index=0
     )
 
-# ФИЛЬТРАЦИЯ ДАННЫХ
-df_filtered = df.copy()
-
-# Применяем фильтры ТОЛЬКО если они выбраны
-if section:
-    df_filtered = df_filtered[df_filtered['section'] == section]
-
-if years:
-    df_filtered = df_filtered[df_filtered['year'].isin(years)]
-
-if selected_regions:
-    df_filtered = df_filtered[df_filtered['region'].isin(selected_regions)]
-
-if selected_substances:
-    df_filtered = df_filtered[df_filtered['substance'].isin(selected_substances)]
-
-# Применяем фильтр по кодам
-if selected_codes:
-    df_filtered = df_filtered[df_filtered['code'].isin(selected_codes)]
+# ФИЛЬТРАЦИЯ ДАННЫХ (выполняется на стороне SQL, результат кэшируется
+# по сигнатуре фильтров — tuple-аргументы хэшируются st.cache_data)
+with st.spinner("Загрузка отфильтрованных данных..."):
+    # Предрассчитанная агрегация, из которой строятся метрики и вкладки;
+    # построчные данные дашборду больше не нужны
+    agg_full = load_aggregated(
+        section=section,
+        years=tuple(years),
+        regions=tuple(selected_regions),
+        substances=tuple(selected_substances),
+        codes=tuple(selected_codes),
+    )
 
 # Основная панель
-if df_filtered.empty:
+if agg_full.empty:
     st.error("Нет данных для отображения с выбранными фильтрами!")
 else:
-    # ВЕРХНИЕ МЕТРИКИ
+    # ВЕРХНИЕ МЕТРИКИ: всё из одного прохода по компактному agg_full,
+    # вместо четырех сканов построчного DataFrame
+    location_totals = agg_full.groupby(location_level, observed=True)['value'].sum()
     col1, col2, col3, col4 = st.columns(4)
-    
+
     with col1:
-        total_emissions = df_filtered['value'].sum() / 1000
+        # Сумма по всем строкам агрегата, включая строки без локации —
+        # итог не зависит от группировки по location_level
+        total_emissions = agg_full['value'].sum() / 1000
         st.metric("Всего выбросов", f"{total_emissions:,.1f} тыс. тонн")
-    
+
     with col2:
-        avg_per_location = df_filtered.groupby(location_level)['value'].sum().mean() / 1000
+        avg_per_location = location_totals.mean() / 1000
         location_label = "региону" if location_level == 'region' else "району"
         st.metric(f"Средние по {location_label}", f"{avg_per_location:,.1f} тыс. тонн")
-    
+
     with col3:
-        locations_count = df_filtered[location_level].nunique()
+        locations_count = len(location_totals)
         st.metric("Локаций", f"{locations_count:,}")
-    
+
     with col4:
-        years_count = df_filtered['year'].nunique()
+        years_count = agg_full['year'].nunique()
         st.metric("Лет", f"{years_count}")
     
     
@@ -409,57 +599,47 @@ else:
             # Группируем по локациям и веществам
             if location_level == 'region':
                 # Используем substance_display для группировки
-                df_grouped = df_filtered.groupby(['region', 'substance_display'])['value'].sum().reset_index()
+                df_grouped = agg_full.groupby(['region', 'substance_display'], observed=True)['value'].sum().reset_index()
                 x_col = 'region'
                 title = "Выбросы по регионам"
                 x_label = 'Регион'
             else:
-                df_grouped = df_filtered.groupby(['municipal_district', 'substance_display'])['value'].sum().reset_index()
+                df_grouped = agg_full.groupby(['municipal_district', 'substance_display'], observed=True)['value'].sum().reset_index()
                 x_col = 'municipal_district'
                 title = "Выбросы по муниципальным районам"
                 x_label = 'Муниципальный район'
             
             # Берем топ-15 локаций для читаемости
-            top_locations = df_grouped.groupby(x_col)['value'].sum().nlargest(15).index
+            top_locations = df_grouped.groupby(x_col, observed=True)['value'].sum().nlargest(15).index
             df_top = df_grouped[df_grouped[x_col].isin(top_locations)]
-            
-            # Проверяем на дублирование
-            unique_substances = df_top['substance_display'].nunique()
-            
-            fig1 = px.bar(
-                df_top,
-                x=x_col,
-                y='value',
-                color='substance_display',
-                barmode='group',
-                title=title,
-                labels={
-                    'value': 'Выбросы (тонны)', 
-                    x_col: x_label,
-                    'substance_display': 'Вещество'
-                },
-                template=chart_theme
+
+            # Пред-пивот и готовые go.Bar-трейсы: по одному numpy-массиву
+            # на вещество вместо per-category цикла plotly-express
+            pivot = df_top.pivot_table(
+                index=x_col, columns='substance_display', values='value',
+                aggfunc='sum', observed=True, fill_value=0
             )
-            
+            fig1 = go.Figure([
+                go.Bar(name=str(c), x=pivot.index, y=pivot[c])
+                for c in pivot.columns
+            ])
+            fig1.update_layout(barmode='group', title=title, template=chart_theme)
+
         else:
             # Несколько лет - группируем по годам
-            df_grouped = df_filtered.groupby(['year', 'substance_display'])['value'].sum().reset_index()
-            
-            # Проверяем на дублирование
-            unique_substances = df_grouped['substance_display'].nunique()
-            
-            fig1 = px.bar(
-                df_grouped,
-                x='year',
-                y='value',
-                color='substance_display',
+            df_grouped = agg_full.groupby(['year', 'substance_display'], observed=True)['value'].sum().reset_index()
+
+            pivot = df_grouped.pivot_table(
+                index='year', columns='substance_display', values='value',
+                aggfunc='sum', observed=True, fill_value=0
+            )
+            fig1 = go.Figure([
+                go.Bar(name=str(c), x=pivot.index, y=pivot[c])
+                for c in pivot.columns
+            ])
+            fig1.update_layout(
                 barmode='group',
                 title="Динамика выбросов по годам",
-                labels={
-                    'value': 'Выбросы (тонны)', 
-                    'year': 'Год',
-                    'substance_display': 'Вещество'
-                },
                 template=chart_theme
             )
         
@@ -476,7 +656,7 @@ else:
         if selected_codes:
             st.subheader("Распределение по выбранным кодам")
             
-            code_grouped = df_filtered.groupby(['code', 'indicator'])['value'].sum().reset_index()
+            code_grouped = agg_full.groupby(['code', 'indicator'], observed=True)['value'].sum().reset_index()
             code_grouped = code_grouped.sort_values('value', ascending=False)
             
             fig_codes = px.bar(
@@ -500,7 +680,7 @@ else:
         
         if len(years) > 1:
             # Линейный график - используем substance_display для уникальности
-            df_trend = df_filtered.groupby(['year', 'substance_display'])['value'].sum().reset_index()
+            df_trend = agg_full.groupby(['year', 'substance_display'], observed=True)['value'].sum().reset_index()
             
             fig3 = px.line(
                 df_trend,
@@ -526,7 +706,7 @@ else:
             if selected_codes:
                 st.subheader("Динамика по выбранным кодам")
                 
-                code_trend = df_filtered.groupby(['year', 'code', 'indicator'])['value'].sum().reset_index()
+                code_trend = agg_full.groupby(['year', 'code', 'indicator'], observed=True)['value'].sum().reset_index()
                 
                 fig_codes_trend = px.line(
                     code_trend,
@@ -552,34 +732,24 @@ else:
             # Анализ роста/спада
             st.subheader("Изменения по сравнению с предыдущим годом")
             
-            changes_data = []
-            # Используем оригинальные коды веществ для анализа
-            unique_substances = df_filtered['substance'].unique()
-            
-            for substance in unique_substances:
-                # Фильтруем по исходному коду вещества
-                sub_df = df_filtered[df_filtered['substance'] == substance].groupby('year')['value'].sum().reset_index()
-                sub_df = sub_df.sort_values('year')
-                
-                if len(sub_df) > 1:
-                    for i in range(1, len(sub_df)):
-                        prev = sub_df.iloc[i-1]['value']
-                        curr_year = sub_df.iloc[i]['year']
-                        curr_val = sub_df.iloc[i]['value']
-                        change_pct = ((curr_val - prev) / prev * 100) if prev > 0 else 0
-                        
-                        display_name = all_substances.get(substance, substance)
-                        
-                        changes_data.append({
-                            'Вещество': display_name,
-                            'Год': curr_year,
-                            'Изменение %': round(change_pct, 1),
-                            'Выбросы, т': round(curr_val, 1),
-                            'Тренд': 'Рост' if change_pct > 0 else 'Спад' if change_pct < 0 else 'Без изменений'
-                        })
-            
-            if changes_data:
-                changes_df = pd.DataFrame(changes_data)
+            # Суммы по (вещество, год) и прирост к предыдущему году одним
+            # групповым pct_change — без циклов по строкам
+            g = agg_full.groupby(['substance', 'year'], observed=True, sort=True)['value'].sum().reset_index()
+            g['change_pct'] = g.groupby('substance', observed=True)['value'].pct_change() * 100
+            g = g.dropna(subset=['change_pct'])
+
+            if not g.empty:
+                changes_df = pd.DataFrame({
+                    'Вещество': g['substance'].astype(str).map(lambda s: all_substances.get(s, s)),
+                    'Год': g['year'],
+                    'Изменение %': g['change_pct'].round(1),
+                    'Выбросы, т': g['value'].round(1),
+                    'Тренд': np.select(
+                        [g['change_pct'] > 0, g['change_pct'] < 0],
+                        ['Рост', 'Спад'],
+                        default='Без изменений'
+                    ),
+                })
                 
                 # Таблица изменений с цветовым кодированием
                 st.dataframe(
@@ -602,9 +772,9 @@ else:
                 )
                 
                 # Сводная статистика по трендам
-                growth_count = len([c for c in changes_data if c['Изменение %'] > 0])
-                decline_count = len([c for c in changes_data if c['Изменение %'] < 0])
-                stable_count = len([c for c in changes_data if c['Изменение %'] == 0])
+                growth_count = int((changes_df['Изменение %'] > 0).sum())
+                decline_count = int((changes_df['Изменение %'] < 0).sum())
+                stable_count = int((changes_df['Изменение %'] == 0).sum())
                 
                 col1, col2, col3 = st.columns(3)
                 with col1:
@@ -621,7 +791,7 @@ else:
         
         if location_level == 'region':
             # Общая сумма по регионам
-            region_data = df_filtered.groupby('region')['value'].sum().reset_index()
+            region_data = agg_full.groupby('region', observed=True)['value'].sum().reset_index()
             region_data = region_data.sort_values('value', ascending=True)
             
             fig5 = px.bar(
@@ -643,7 +813,7 @@ else:
             
         else:
             # Для муниципальных районов
-            district_data = df_filtered.groupby(['region', 'municipal_district'])['value'].sum().reset_index()
+            district_data = agg_full.groupby(['region', 'municipal_district'], observed=True)['value'].sum().reset_index()
             district_data = district_data.sort_values('value', ascending=False).head(20)
             
             fig6 = px.bar(
@@ -662,11 +832,19 @@ else:
     with tab4:
         st.subheader("Детальные данные")
         
+        # Ограничиваемся топ-200 локаций ДО многоключевой группировки —
+        # дальше таблицы всё равно никто не листает
+        top_detail_locations = (
+            agg_full.groupby(location_level, observed=True)['value']
+            .sum().nlargest(200).index
+        )
+        detail_src = agg_full[agg_full[location_level].isin(top_detail_locations)]
+
         # Простая группировка для отображения с названиями веществ
         if location_level == 'region':
-            detail_df = df_filtered.groupby(['region', 'code', 'indicator', 'substance', 'substance_display', 'year'])['value'].sum().reset_index()
+            detail_df = detail_src.groupby(['region', 'code', 'indicator', 'substance', 'substance_display', 'year'], observed=True)['value'].sum().reset_index()
         else:
-            detail_df = df_filtered.groupby(['region', 'municipal_district', 'code', 'indicator', 'substance', 'substance_display', 'year'])['value'].sum().reset_index()
+            detail_df = detail_src.groupby(['region', 'municipal_district', 'code', 'indicator', 'substance', 'substance_display', 'year'], observed=True)['value'].sum().reset_index()
         
         # Форматирование
         detail_df['Выбросы (т)'] = detail_df['value'].round(2)
@@ -694,19 +872,22 @@ else:
         # Статистика по данным
         st.subheader("Статистика по выбранным данным")
         
-        # По веществам (используем отображаемые названия)
+        # По веществам: считаем по agg_full, а не повторной группировкой
+        # уже отформатированной таблицы
         if len(display_df) > 0:
-            substance_stats = display_df.groupby('Вещество')['Выбросы (т)'].agg(['sum', 'mean', 'median', 'max']).round(1)
+            substance_stats = agg_full.groupby('substance_display', observed=True)['value'].agg(['sum', 'mean', 'median', 'max']).round(1)
             substance_stats.columns = ['Сумма, т', 'Среднее, т', 'Медиана, т', 'Максимум, т']
-            
+            substance_stats.index.name = 'Вещество'
+
             st.write("**Статистика по веществам:**")
             st.dataframe(substance_stats, width='stretch')
-            
+
             # Статистика по кодам
             if selected_codes:
-                code_stats = display_df.groupby('Код показателя')['Выбросы (т)'].agg(['sum', 'mean', 'median', 'max']).round(1)
+                code_stats = agg_full.groupby('code', observed=True)['value'].agg(['sum', 'mean', 'median', 'max']).round(1)
                 code_stats.columns = ['Сумма, т', 'Среднее, т', 'Медиана, т', 'Максимум, т']
-                
+                code_stats.index.name = 'Код показателя'
+
                 st.write("**Статистика по кодам показателей:**")
                 st.dataframe(code_stats, width='stretch')
 